@@ -35,10 +35,13 @@ CLASSIFIERS = [
 
 ]
 INSTALL_REQUIRES = [
+    "cachetools",
     "fastapi",
+    "msgpack",
+    "orjson",
     "pydantic",
-    "python-dateutil",
-    "redis",
+    "redis[hiredis]>=5.0.1",
+    "xxhash",
 ]
 
 # Execute version.py and get __version__
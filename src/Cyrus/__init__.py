@@ -7,4 +7,4 @@ from .cache import (
     cache_one_week,
     cache_one_year,
 )
-from .client import Cyrus
+from .client import Cyrus, get_cyrus
@@ -1,24 +1,29 @@
 """cache.py"""
 import asyncio
-import json
 from datetime import timedelta
-from functools import partial , wraps , update_wrapper
+from functools import wraps
 from http import HTTPStatus
+from inspect import signature
 from typing import Union
 
 from fastapi import Response
 
-from .client import Cyrus
+from .client import INFLIGHT_TTL_MS, get_cyrus
 from .util import (
-    deserialize_json,
     ONE_DAY_IN_SECONDS,
     ONE_HOUR_IN_SECONDS,
+    ONE_MINUTE_IN_SECONDS,
     ONE_MONTH_IN_SECONDS,
     ONE_WEEK_IN_SECONDS,
     ONE_YEAR_IN_SECONDS,
-    serialize_json,
+    dumps_json,
+    unpack_cached,
 )
 
+# Waiting for another request to cache a missing value gives up once its in-flight marker has expired
+INFLIGHT_RETRY_DELAY = 0.05
+INFLIGHT_MAX_RETRIES = round(INFLIGHT_TTL_MS / 1000 / INFLIGHT_RETRY_DELAY)
+
 
 def cache(*, expire: Union[int, timedelta] = ONE_YEAR_IN_SECONDS):
     """Enable caching behavior for the decorated function.
@@ -28,19 +33,28 @@ def cache(*, expire: Union[int, timedelta] = ONE_YEAR_IN_SECONDS):
             from now when the cached response should expire. Defaults to 31,536,000
             seconds (i.e., the number of seconds in one year).
     """
+    ttl = calculate_ttl(expire)
 
     def outer_wrapper(func):
+        # Looked up on first use, since `Cyrus` is normally configured after endpoints are decorated.
+        redis_cache = None
+        key_builder = None
+        func_params = signature(func).parameters
+        has_request = "request" in func_params
+        has_response = "response" in func_params
+
         @wraps(func)
         async def inner_wrapper(*args, **kwargs):
             """Return cached value if one exists, otherwise evaluate the wrapped function and cache the result."""
+            nonlocal redis_cache, key_builder
 
-            func_kwargs = kwargs.copy()
-            request = func_kwargs.pop("request", None)
-            response = func_kwargs.pop("response", None)
+            request = kwargs.get("request") if has_request else None
+            response = kwargs.get("response") if has_response else None
             create_response_directly = not response
             if create_response_directly:
                 response = Response()
-            redis_cache = Cyrus()
+            if redis_cache is None:
+                redis_cache = get_cyrus()
 
             if redis_cache.not_connected or redis_cache.request_is_not_cacheable(
                 request
@@ -48,41 +62,45 @@ def cache(*, expire: Union[int, timedelta] = ONE_YEAR_IN_SECONDS):
                 # If the redis client is not connected or the request is not cacheable, no caching behavior is performed.
                 return await get_api_response_async(func, *args, **kwargs)
 
-            key = redis_cache.get_cache_key(func, *args, **kwargs)
-            ttl, in_cache = redis_cache.check_cache(key)
+            if key_builder is None:
+                key_builder = redis_cache.build_key_builder(func)
+            key = key_builder(*args, **kwargs)
+            remaining_ttl, in_cache, in_flight = await redis_cache.check_cache(key)
+            retries = 0
+            while in_flight and retries < INFLIGHT_MAX_RETRIES:
+                # Another request is already computing this value, wait for it instead of recomputing it
+                await asyncio.sleep(INFLIGHT_RETRY_DELAY)
+                retries += 1
+                remaining_ttl, in_cache, in_flight = await redis_cache.check_cache(key)
 
             if in_cache:
-                redis_cache.set_response_headers(
-                    response, True, deserialize_json(in_cache), ttl
-                )
+                redis_cache.set_response_headers(response, True, in_cache, remaining_ttl)
                 if redis_cache.requested_resource_not_modified(request, in_cache):
                     response.status_code = int(HTTPStatus.NOT_MODIFIED)
                     return create_response(response, None, create_response_directly)
 
-                # Convert bytes key to json
-                # converted_json_data = json.loads(in_cache)
-                # converted_json_data = converted_json_data[key] if key in converted_json_data else converted_json_data
-
-                converted_json_data = json.loads(in_cache).get(key , json.loads(in_cache))
-
-                return create_response(response, str(converted_json_data), create_response_directly)
+                return create_response(
+                    response, dumps_json(unpack_cached(key, in_cache)), create_response_directly
+                )
 
-            response_data = await get_api_response_async(func, *args, **kwargs)
-            ttl = calculate_ttl(expire)
-            cached, serialized_dict = redis_cache.add_to_cache(key, response_data, ttl)
+            # Without a value and without being told to wait, this request claimed the in-flight marker
+            claimed = not in_flight
+            cached = False
+            try:
+                response_data = await get_api_response_async(func, *args, **kwargs)
+                cached, body, serialized = await redis_cache.add_to_cache(
+                    key, response_data, ttl, claimed
+                )
+            finally:
+                # Caching the value clears the marker, otherwise waiters would sit out its whole TTL
+                if claimed and not cached:
+                    await redis_cache.release_inflight(key)
 
             if cached:
                 redis_cache.set_response_headers(
-                    response, cache_hit=False, response_data=response_data, ttl=ttl
+                    response, cache_hit=False, cached_data=serialized, ttl=ttl
                 )
-                if hasattr(response_data, "__len__"):
-                    return create_response(
-                        response, serialize_json(response_data), create_response_directly
-                    )
-                else:
-                    return create_response(
-                        response , serialized_dict[key][0] , create_response_directly
-                    )
+                return create_response(response, body, create_response_directly)
 
             return response_data
 
@@ -110,37 +128,38 @@ def calculate_ttl(expire: Union[int, timedelta]) -> int:
 def create_response(response, content, create_directly):
     """Creates a FastAPI response."""
     if create_directly:
+        # Starlette sets `Content-Length` from the body; the placeholder's own (empty body) value must not be copied
+        headers = {
+            name: value
+            for name, value in response.headers.items()
+            if name != "content-length"
+        }
+        if content is None:
+            return Response(status_code=response.status_code, headers=headers)
         return Response(
-            content = content ,
-            media_type = "application/json" ,
-            headers = {"Content-Length": str(len(content))} ,
-            status_code = response.status_code ,
+            content=content,
+            status_code=response.status_code,
+            headers=headers,
+            media_type="application/json",
         )
     return content
 
 
-# Combine 2 funcs into 1
-cache_one_minute = partial(cache, expire=60)
-cache_one_hour = partial(cache, expire=ONE_HOUR_IN_SECONDS)
-cache_one_day = partial(cache, expire=ONE_DAY_IN_SECONDS)
-cache_one_week = partial(cache, expire=ONE_WEEK_IN_SECONDS)
-cache_one_month = partial(cache, expire=ONE_MONTH_IN_SECONDS)
-cache_one_year = partial(cache, expire=ONE_YEAR_IN_SECONDS)
-
-
-for cache_wrapper in [
-    cache_one_minute,
-    cache_one_hour,
-    cache_one_day,
-    cache_one_week,
-    cache_one_month,
-    cache_one_year,
-]:
-    wraps(cache_wrapper)(cache)
-
-# update_wrapper(cache_one_minute, cache)
-# update_wrapper(cache_one_hour, cache)
-# update_wrapper(cache_one_day, cache)
-# update_wrapper(cache_one_week, cache)
-# update_wrapper(cache_one_month, cache)
-# update_wrapper(cache_one_year, cache)
\ No newline at end of file
+def _make_cache(name: str, expire: int):
+    """Return a `cache` decorator factory with `expire` baked in."""
+
+    def cache_n(*, expire: Union[int, timedelta] = expire):
+        return cache(expire=expire)
+
+    # Not `update_wrapper`, `__wrapped__` would make `inspect.signature` report the signature of `cache`
+    cache_n.__doc__ = cache.__doc__
+    cache_n.__name__ = cache_n.__qualname__ = name
+    return cache_n
+
+
+cache_one_minute = _make_cache("cache_one_minute", ONE_MINUTE_IN_SECONDS)
+cache_one_hour = _make_cache("cache_one_hour", ONE_HOUR_IN_SECONDS)
+cache_one_day = _make_cache("cache_one_day", ONE_DAY_IN_SECONDS)
+cache_one_week = _make_cache("cache_one_week", ONE_WEEK_IN_SECONDS)
+cache_one_month = _make_cache("cache_one_month", ONE_MONTH_IN_SECONDS)
+cache_one_year = _make_cache("cache_one_year", ONE_YEAR_IN_SECONDS)
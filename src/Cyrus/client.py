@@ -1,21 +1,69 @@
-import json
+import asyncio
 import logging
-from datetime import datetime, timedelta
-from typing import Callable, Dict, List, Optional, Tuple, Type, Union
+import time
+from datetime import datetime
+from email.utils import formatdate
+from functools import lru_cache, partial
+from typing import Callable, Dict, List, Optional, Set, Tuple, Type
 
+from xxhash import xxh3_64_hexdigest
+from cachetools import TTLCache
+import redis.asyncio as aioredis
+from redis.exceptions import NoScriptError
 from fastapi import Request, Response
-from redis import client
 from sqlalchemy.orm import registry
 
 from .enums import RedisEvent, RedisStatus
-from .key_gen import get_cache_key
-from .redis import redis_connect
-from .util import serialize_json
+from .key_gen import build_key_builder, get_cache_key
+from .redis import DEFAULT_MAX_CONNECTIONS, redis_connect
+from .util import (
+    ONE_DAY_IN_SECONDS,
+    ONE_HOUR_IN_SECONDS,
+    ONE_MINUTE_IN_SECONDS,
+    ONE_MONTH_IN_SECONDS,
+    ONE_WEEK_IN_SECONDS,
+    ONE_YEAR_IN_SECONDS,
+    dumps_json,
+    encode_payload,
+    pack_cached,
+)
 
 DEFAULT_RESPONSE_HEADER = "X-FastAPI-Cache"
-ALLOWED_HTTP_TYPES = ["GET"]
+ALLOWED_HTTP_TYPES = frozenset({"GET"})
+NO_CACHE_DIRECTIVES = frozenset({"no-store", "no-cache"})
+DEFAULT_L1_TTL = 1.0
+DEFAULT_L1_MAXSIZE = 10_000
+DEFAULT_BATCH_WINDOW_MS = 1.0
 LOG_TIMESTAMP = "%m/%d/%Y %I:%M:%S %p"
-HTTP_TIME = "%a, %d %b %Y %H:%M:%S GMT"
+# `Cache-Control` values for the TTLs of the pre-defined lifetimes
+CACHE_CONTROL_HEADERS = {
+    ttl: f"max-age={ttl}"
+    for ttl in (
+        ONE_MINUTE_IN_SECONDS,
+        ONE_HOUR_IN_SECONDS,
+        ONE_DAY_IN_SECONDS,
+        ONE_WEEK_IN_SECONDS,
+        ONE_MONTH_IN_SECONDS,
+        ONE_YEAR_IN_SECONDS,
+    )
+}
+# How long a request computing a missing value holds the in-flight marker for its key
+INFLIGHT_TTL_MS = 5000
+# Fetch the remaining TTL (in seconds) and the cached value in a single round-trip. On a miss,
+# the first caller claims the in-flight marker (KEYS[2]) and later callers are told to wait.
+# Values written by `pack_cached` are one-entry MessagePack maps (first byte 0x81), anything
+# else was cached by an older version and is treated as a miss so that it gets overwritten.
+LUA_CHECK_CACHE = """
+local ttl = redis.call('TTL', KEYS[1])
+local value = redis.call('GET', KEYS[1])
+if value and string.byte(value, 1) == 0x81 then
+    return {ttl, value, 0}
+end
+if redis.call('SET', KEYS[2], 1, 'NX', 'PX', ARGV[1]) then
+    return {ttl, false, 0}
+end
+return {ttl, false, 1}
+"""
 
 # Default Logging_system
 logging.basicConfig()
@@ -23,29 +71,56 @@ logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
 
 
-class MetaSingleton(type):
-    """Metaclass for creating classes that allow only a single instance to be created."""
+def inflight_key(key: str) -> str:
+    """Name of the marker held while a request computes the value for `key`."""
+    return f"{key}:inflight"
 
-    _instances = {}
 
-    def __call__(cls, *args, **kwargs):
-        if cls not in cls._instances:
-            cls._instances[cls] = super().__call__(*args, **kwargs)
-        return cls._instances[cls]
+@lru_cache(maxsize=1)
+def _log_time(timestamp: int) -> str:
+    """Format `timestamp` for log messages, memoized since it only changes once a second."""
+    return time.strftime(LOG_TIMESTAMP, time.localtime(timestamp))
 
 
-class Cyrus(metaclass=MetaSingleton):
-    """Communicates with Redis server to cache API response data."""
+@lru_cache(maxsize=128)
+def _http_time(timestamp: int) -> str:
+    """Format `timestamp` for HTTP headers, memoized to the second (one entry per TTL in use)."""
+    return formatdate(timestamp, usegmt=True)
+
+
+# The one `Cyrus` instance, set the first time the class is instantiated
+_INSTANCE: Optional["Cyrus"] = None
+
+
+def get_cyrus() -> "Cyrus":
+    """Return the `Cyrus` instance, creating one with the default settings if needed."""
+    return _INSTANCE or Cyrus()
+
+
+class Cyrus:
+    """Communicates with Redis server to cache API response data. Only a single instance is ever created."""
 
     host_url: str
     prefix: str = None
     response_header: str = None
     status: RedisStatus = RedisStatus.NONE
-    redis: client.Redis = None
+    redis: aioredis.Redis = None
+    check_cache_sha: str = None
     logger_system: logging.Logger = None
     local: bool = False
     password: str = None
     port: int = 0
+    max_connections: int = DEFAULT_MAX_CONNECTIONS
+    l1_ttl: float = DEFAULT_L1_TTL
+    batch_window_ms: float = DEFAULT_BATCH_WINDOW_MS
+
+    _initialized: bool = False
+
+    def __new__(cls, *args, **kwargs):
+        global _INSTANCE
+        if _INSTANCE is None:
+            _INSTANCE = super().__new__(cls)
+        return _INSTANCE
 
     @property
     def connected(self):
@@ -65,6 +140,10 @@ class Cyrus(metaclass=MetaSingleton):
         host_url: str = "localhost",
         password: Optional[str] = None,
         port: Optional[int] = 0,
+        max_connections: int = DEFAULT_MAX_CONNECTIONS,
+        l1_ttl: float = DEFAULT_L1_TTL,
+        l1_maxsize: int = DEFAULT_L1_MAXSIZE,
+        batch_window_ms: float = DEFAULT_BATCH_WINDOW_MS,
     ) -> None:
         """Initialize the redis system you can `config` the essential settings.
         Args:
@@ -83,7 +162,19 @@ class Cyrus(metaclass=MetaSingleton):
              host_url (str): URL for a Redis database.
              password (str, optional): Password for Redis Cloud.
              port (int, optional): Port number for Redis Cloud.
+             max_connections (int, optional): Size of the connection pool, requests
+                 wait for a free connection once it is exhausted. Defaults to 50.
+             l1_ttl (float, optional): Number of seconds a cached value is also kept in
+                 process memory, in front of Redis. Set to 0 to disable. Defaults to 1.
+             l1_maxsize (int, optional): Maximum number of keys held in process memory.
+                 Defaults to 10,000.
+             batch_window_ms (float, optional): Cache lookups made by concurrent requests
+                 within this many milliseconds are sent to Redis in a single pipeline.
+                 Defaults to 1.
         """
+        if self._initialized:
+            return
+        self._initialized = True
         self.prefix = prefix
         self.response_header = response_header or DEFAULT_RESPONSE_HEADER
         self.ignore_arg_types = ignore_arg_types
@@ -92,6 +183,14 @@ class Cyrus(metaclass=MetaSingleton):
         self.host_url = host_url
         self.password = password
         self.port = port
+        self.max_connections = max_connections
+        self.l1_ttl = l1_ttl
+        self._l1 = TTLCache(maxsize=l1_maxsize, ttl=l1_ttl) if l1_ttl else None
+        self.batch_window_ms = batch_window_ms
+        self._pending: Dict[str, asyncio.Future] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+        # Strong references to fire-and-forget tasks, the event loop only keeps weak ones
+        self._background_tasks: Set[asyncio.Task] = set()
 
         self._connect()
 
@@ -100,9 +199,11 @@ class Cyrus(metaclass=MetaSingleton):
             RedisEvent.CONNECT_BEGIN, msg="Attempting to connect to Redis server..."
         )
         self.status, self.redis = redis_connect(
-            self.host_url, self.local, self.password, self.port
+            self.host_url, self.local, self.password, self.port, self.max_connections
         )
         if self.status == RedisStatus.CONNECTED:
+            # Only the SHA is kept, a `Script` queued in a pipeline costs an extra `SCRIPT EXISTS` round-trip
+            self.check_cache_sha = self.redis.register_script(LUA_CHECK_CACHE).sha
             self.log(
                 RedisEvent.CONNECT_SUCCESS, msg="Redis client is connected to server."
             )
@@ -120,15 +221,98 @@ class Cyrus(metaclass=MetaSingleton):
     def get_cache_key(self, func: Callable, *args: List, **kwargs: Dict) -> str:
         return get_cache_key(self.prefix, self.ignore_arg_types, func, *args, **kwargs)
 
-    def check_cache(self, key: str) -> Tuple[int, str]:
-        pipe = self.redis.pipeline()
-        ttl, in_cache = pipe.ttl(key).get(key).execute()
+    def build_key_builder(self, func: Callable) -> Callable[..., str]:
+        return build_key_builder(func, self.prefix, self.ignore_arg_types)
+
+    async def close(self) -> None:
+        """Close the connection pool, call it from your app's `shutdown` event."""
+        if self.redis is None:
+            return
+        redis_client, self.redis = self.redis, None
+        self.status = RedisStatus.NONE
+        # Shielded so a cancelled shutdown can't leave the pool half-closed
+        await asyncio.shield(redis_client.aclose())
+
+    async def check_cache(self, key: str) -> Tuple[int, bytes, bool]:
+        """Return the remaining TTL and cached value for `key`, and whether another request is computing it."""
+        if self._l1 is not None:
+            expires_at, in_cache = self._l1.get(key, (0, None))
+            ttl = int(expires_at - time.monotonic())
+            if ttl > 0:
+                self.log(RedisEvent.KEY_FOUND_IN_CACHE, key=key)
+                return ttl, in_cache, False
+        ttl, in_cache, in_flight = await self._batched_check(key)
         if in_cache:
+            self._add_to_l1(key, in_cache, ttl)
             self.log(RedisEvent.KEY_FOUND_IN_CACHE, key=key)
-        return ttl, in_cache
+        return ttl, in_cache, bool(in_flight)
+
+    async def _batched_check(self, key: str) -> Tuple[int, bytes, int]:
+        """Queue `key` for the next pipelined lookup, concurrent lookups of the same key share one result."""
+        future = self._pending.get(key)
+        shared = future is not None
+        if not shared:
+            future = asyncio.get_running_loop().create_future()
+            self._pending[key] = future
+            if self._flush_task is None:
+                self._flush_task = asyncio.create_task(self._flush_pending())
+        try:
+            # Shielded so one cancelled request doesn't cancel the lookup for every other waiter
+            ttl, in_cache, in_flight = await asyncio.shield(future)
+        except asyncio.CancelledError:
+            if not shared:
+                future.add_done_callback(partial(self._release_abandoned_claim, key))
+            raise
+        if shared and not in_cache:
+            # Only the request that queued the key owns the in-flight marker it may have claimed
+            in_flight = 1
+        return ttl, in_cache, in_flight
+
+    def _release_abandoned_claim(self, key: str, future: asyncio.Future) -> None:
+        """Release the marker claimed for a cancelled request, waiters sharing its lookup would sit out its TTL."""
+        if future.cancelled() or future.exception() is not None:
+            return
+        _, in_cache, in_flight = future.result()
+        if in_cache or in_flight:
+            return
+        task = asyncio.create_task(self.release_inflight(key))
+        self._background_tasks.add(task)
+        task.add_done_callback(self._background_tasks.discard)
+
+    async def _flush_pending(self) -> None:
+        await asyncio.sleep(self.batch_window_ms / 1000)
+        pending, self._pending = self._pending, {}
+        self._flush_task = None
+        try:
+            try:
+                results = await self._check_keys(pending)
+            except NoScriptError:
+                # First use, or the server's script cache was flushed: load the script and retry once
+                await self.redis.script_load(LUA_CHECK_CACHE)
+                results = await self._check_keys(pending)
+        except Exception as e:
+            for future in pending.values():
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for future, result in zip(pending.values(), results):
+            if not future.done():
+                future.set_result(result)
+
+    async def _check_keys(self, keys) -> List:
+        """Run the cache check script for every key in a single pipeline."""
+        pipe = self.redis.pipeline(transaction=False)
+        for key in keys:
+            pipe.evalsha(self.check_cache_sha, 2, key, inflight_key(key), INFLIGHT_TTL_MS)
+        return await pipe.execute()
+
+    def _add_to_l1(self, key: str, value: bytes, ttl: int) -> None:
+        """Keep `value` in process memory until the L1 TTL or the Redis TTL runs out, whichever comes first."""
+        if self._l1 is not None and ttl > 0:
+            self._l1[key] = (time.monotonic() + ttl, value)
 
     def requested_resource_not_modified(
-        self, request: Request, cached_data: str
+        self, request: Request, cached_data: bytes
     ) -> bool:
         if not request or "If-None-Match" not in request.headers:
             return False
@@ -143,39 +327,50 @@ class Cyrus(metaclass=MetaSingleton):
         excluded_types = (datetime , dict, registry, datetime)  # Add other types you want to exclude
         return {key: value for key , value in obj.__dict__.items() if not isinstance(value , excluded_types)}
 
-    def add_to_cache(self, key: str, value: Dict, expire: int) -> bool:
+    async def add_to_cache(
+        self, key: str, value: Dict, expire: int, claimed: bool = False
+    ) -> Tuple[bool, Optional[bytes], Optional[bytes]]:
+        """Cache `value` under `key`, returning whether it was cached along with its JSON body and the stored bytes.
+
+        The in-flight marker for `key` is cleared along with it when `claimed` is set, i.e. only by the
+        request that holds it; a request that gave up waiting must not reopen the key to a stampede.
+        """
         try:
-            if hasattr(value , "__len__"):
-                serialized_messages = [serialize_json(obj.__dict__) for obj in value]
-            else:
-                serialized_messages = [serialize_json(value.__dict__)]
-            serialized_dict = {key: serialized_messages} if serialized_messages else {}
+            payload = encode_payload(value if hasattr(value , "__len__") else value.__dict__)
+            body = dumps_json(payload)
+            serialized = pack_cached(key, payload)
         except TypeError as e:
             message = f"Object of type {type(value)} is not JSON-serializable: => str{e}"
             self.log(RedisEvent.FAILED_TO_CACHE_KEY, msg=message, key=key)
-            return False
-        cached = self.redis.set(name=key, value=json.dumps(serialized_dict), ex=expire)
+            return False, None, None
+        if claimed:
+            pipe = self.redis.pipeline(transaction=False)
+            cached, _ = await pipe.set(name=key, value=serialized, ex=expire).delete(inflight_key(key)).execute()
+        else:
+            cached = await self.redis.set(name=key, value=serialized, ex=expire)
         if cached:
+            self._add_to_l1(key, serialized, expire)
             self.log(RedisEvent.KEY_ADDED_TO_CACHE, key=key)
         else:
             self.log(RedisEvent.FAILED_TO_CACHE_KEY, key=key, value=value)
-        return cached , serialized_dict
+        return cached , body, serialized
+
+    async def release_inflight(self, key: str) -> None:
+        """Drop the in-flight marker for `key` so waiting requests stop waiting for a value that won't be cached."""
+        await self.redis.delete(inflight_key(key))
 
     def set_response_headers(
         self,
         response: Response,
         cache_hit: bool,
-        response_data: Dict = None,
+        cached_data: Optional[bytes] = None,
         ttl: int = None,
     ) -> None:
         response.headers[self.response_header] = "Hit" if cache_hit else "Miss"
-        expires_at = datetime.utcnow() + timedelta(seconds=ttl)
-        response.headers["Expires"] = expires_at.strftime(HTTP_TIME)
-        response.headers["Cache-Control"] = f"max-age={ttl}"
-        # test, cached_data = self.get_etag(response_data)
-        # response.headers["ETag"] = test
-        # if "last_modified" in cached_data:  # pragma: no cover
-        #     response.headers["Last-Modified"] = response_data["last_modified"]
+        response.headers["Expires"] = _http_time(int(time.time()) + ttl)
+        response.headers["Cache-Control"] = CACHE_CONTROL_HEADERS.get(ttl) or f"max-age={ttl}"
+        if cached_data:
+            response.headers["ETag"] = self.get_etag(cached_data)
 
     def log(
         self,
@@ -185,6 +380,8 @@ class Cyrus(metaclass=MetaSingleton):
         value: Optional[str] = None,
     ):
         """Log `RedisEvent` using the configured `Logger` object"""
+        if not self.logger_system.isEnabledFor(logging.INFO):
+            return
         message = f"{self.get_log_time()} | {event.name}"
         if msg:
             message += f": {msg}"
@@ -192,42 +389,30 @@ class Cyrus(metaclass=MetaSingleton):
             message += f": key={key}"
         if value:
             message += f", value={value}"
-        logger.info(message)
-
-    #? Rebuild Required
-    # @staticmethod
-    # def get_etag(cached_data: Union[str, bytes, Dict]) -> str:
-    #
-    #     if isinstance(cached_data, bytes):
-    #         cached_data = cached_data.decode()
-    #
-    #     if hasattr(cached_data, "__len__"):
-    #
-    #         for obj in cached_data:
-    #             serialized_messages = []
-    #             # filtered_value = self.filter_attributes(obj.__dict__)
-    #             serialized_object = serialize_json(obj.__dict__)
-    #             # serialized_messages.append(serialized_object)
-    #             serialized_messages.append(serialized_object)
-    #
-    #
-    #         return f"W/{hash(tuple(serialized_messages))}", serialized_messages
-    #
-    #     if isinstance(cached_data.__dict__, dict):
-    #         cached_data = serialize_json(cached_data.__dict__)
-    #     return f"W/{hash(cached_data)}" , cached_data
+        self.logger_system.info(message)
+
+    @staticmethod
+    def get_etag(cached_data: bytes) -> str:
+        """Weak ETag derived from the cached bytes, so the value is never re-serialized to compute it."""
+        return f'W/"{xxh3_64_hexdigest(cached_data)}"'
 
     @staticmethod
     def get_log_time():
         """Get a timestamp to include with a log message."""
-        return datetime.now().strftime(LOG_TIMESTAMP)
+        return _log_time(int(time.time()))
 
     @staticmethod
     def request_is_not_cacheable(request: Request) -> bool:
-        return request and (
-            request.method not in ALLOWED_HTTP_TYPES
-            or any(
-                directive in request.headers.get("Cache-Control", "")
-                for directive in ["no-store", "no-cache"]
-            )
-        )
+        if not request:
+            return False
+        if request.method not in ALLOWED_HTTP_TYPES:
+            return True
+        cache_control = request.headers.get("Cache-Control")
+        if cache_control is None:
+            return False
+        # Directives may carry arguments, e.g. `no-cache="Set-Cookie"`
+        directives = {
+            directive.split("=", 1)[0].strip().lower()
+            for directive in cache_control.split(",")
+        }
+        return not NO_CACHE_DIRECTIVES.isdisjoint(directives)
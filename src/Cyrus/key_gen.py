@@ -1,13 +1,20 @@
 # """cache.py"""
 from collections import OrderedDict
-from inspect import signature, Signature
-from typing import Any, Callable, Dict, List
+from functools import lru_cache
+from inspect import Parameter, signature, Signature
+from typing import Any, Callable, Dict, FrozenSet, List, Optional, Tuple
 
 from fastapi import Request, Response
+from xxhash import xxh3_64_hexdigest
 
-from .types import ArgType, SigParameters
+from .types import ArgType
 
-ALWAYS_IGNORE_ARG_TYPES = [Response, Request]
+ALWAYS_IGNORE_ARG_TYPES = frozenset([Response, Request])
+# Longer argument strings keep this many characters and replace the rest with its hash
+MAX_ARGS_STR_LENGTH = 256
+_VAR_KINDS = (Parameter.VAR_POSITIONAL, Parameter.VAR_KEYWORD)
+# Names used inside generated key functions, parameters must not clash with them
+_GENERATED_PREFIX = "_cyrus_"
 
 
 def get_cache_key(
@@ -18,14 +25,109 @@ def get_cache_key(
     **kwargs: Dict,
 ) -> str:
     """Generate a unique identifier for the function and its arguments, suitable for use as a cache key."""
-    ignore_arg_types = list(set(ignore_arg_types or []) | set(ALWAYS_IGNORE_ARG_TYPES))
-    prefix = f"{prefix}:" if prefix else ""
+    ignore_arg_types = frozenset(ignore_arg_types or ())
+    return _cached_key_builder(func, prefix, ignore_arg_types)(*args, **kwargs)
 
+
+@lru_cache(maxsize=None)
+def _cached_key_builder(
+    func: Callable, prefix: Optional[str], ignore_arg_types: FrozenSet[ArgType]
+) -> Callable[..., str]:
+    return build_key_builder(func, prefix, ignore_arg_types)
+
+
+def build_key_builder(
+    func: Callable,
+    prefix: Optional[str],
+    ignore_arg_types: Optional[List[ArgType]],
+) -> Callable[..., str]:
+    """Return a function that generates cache keys for `func`, with all per-function work done up front."""
+    sig, params = _sig_for(func)
+    ignore_arg_types = _ignore_types_for(ignore_arg_types)
+    # Everything up to the arguments is fixed per function, e.g. `myapi-cache:app.routers.user.get_user(`
+    key_prefix = f"{prefix}:" if prefix else ""
+    prefix_str = f"{key_prefix}{func.__module__}.{func.__name__}("
+
+    ignore_mask = tuple(param.annotation in ignore_arg_types for _, param in params)
+    if not any(
+        param.kind in _VAR_KINDS or name.startswith(_GENERATED_PREFIX)
+        for name, param in params
+    ):
+        return build_source_key_fn(params, ignore_mask, prefix_str)
+
+    # Variadic parameters can't be spelled out in generated code, let `Signature.bind` sort them out
+    ignored = frozenset(
+        name for (name, _), is_ignored in zip(params, ignore_mask) if is_ignored
+    )
+
+    def bound_key_builder(*args: List, **kwargs: Dict) -> str:
+        func_args = get_func_args(sig, *args, **kwargs)
+        args_str = ",".join(
+            [f"{arg}={val}" for arg, val in func_args.items() if arg not in ignored]
+        )
+        return prefix_str + _bound_args_str(args_str) + ")"
+
+    return bound_key_builder
+
+
+def build_source_key_fn(
+    params: Tuple[Tuple[str, Parameter], ...],
+    ignore_mask: Tuple[bool, ...],
+    prefix_str: str,
+) -> Callable[..., str]:
+    """Compile a key function with the same parameters as the endpoint and the key format hardcoded.
+
+    Python binds the arguments itself when the generated function is called, and
+    ignored parameters are left out of the f-string at generation time, e.g.
+    `def key_fn(id, db=_cyrus_default_1): return _cyrus_prefix + _cyrus_bound(f'id={id}') + ')'`.
+    """
+    namespace = {"_cyrus_prefix": prefix_str, "_cyrus_bound": _bound_args_str}
+    arg_list = []
+    kind = None
+    for i, (name, param) in enumerate(params):
+        if kind == Parameter.POSITIONAL_ONLY and param.kind != kind:
+            arg_list.append("/")
+        if param.kind == Parameter.KEYWORD_ONLY and kind != Parameter.KEYWORD_ONLY:
+            arg_list.append("*")
+        kind = param.kind
+        if param.default is Parameter.empty:
+            arg_list.append(name)
+        else:
+            namespace[f"_cyrus_default_{i}"] = param.default
+            arg_list.append(f"{name}=_cyrus_default_{i}")
+    if kind == Parameter.POSITIONAL_ONLY:
+        arg_list.append("/")
+
+    args_str = ",".join(
+        f"{name}={{{name}}}" for (name, _), ignored in zip(params, ignore_mask) if not ignored
+    )
+    source = (
+        f"def key_fn({', '.join(arg_list)}):\n"
+        f"    return _cyrus_prefix + _cyrus_bound(f'{args_str}') + ')'\n"
+    )
+    exec(source, namespace)
+    return namespace["key_fn"]
+
+
+def _bound_args_str(args_str: str) -> str:
+    """Keep Redis keys bounded by hashing the tail of very long argument strings."""
+    if len(args_str) <= MAX_ARGS_STR_LENGTH:
+        return args_str
+    tail = args_str[MAX_ARGS_STR_LENGTH:]
+    return f"{args_str[:MAX_ARGS_STR_LENGTH]}~{xxh3_64_hexdigest(tail.encode())}"
+
+
+@lru_cache(maxsize=None)
+def _sig_for(func: Callable) -> Tuple[Signature, Tuple[Tuple[str, Any], ...]]:
+    """Return the (memoized) signature of `func` along with its parameters."""
     sig = signature(func)
-    func_args = get_func_args(sig, *args, **kwargs)
-    args_str = get_args_str(sig.parameters, func_args, ignore_arg_types)
+    return sig, tuple(sig.parameters.items())
 
-    return f"{prefix}{func.__module__}.{func.__name__}({args_str})"
+
+def _ignore_types_for(ignore_arg_types: Optional[List[ArgType]]) -> FrozenSet[ArgType]:
+    if not ignore_arg_types:
+        return ALWAYS_IGNORE_ARG_TYPES
+    return ALWAYS_IGNORE_ARG_TYPES.union(ignore_arg_types)
 
 
 def get_func_args(
@@ -35,17 +137,3 @@ def get_func_args(
     func_args = sig.bind(*args, **kwargs)
     func_args.apply_defaults()
     return func_args.arguments
-
-
-def get_args_str(
-    sig_params: SigParameters,
-    func_args: "OrderedDict[str, Any]",
-    ignore_arg_types: List[ArgType],
-) -> str:
-    """Return a string representation of the arguments and their values."""
-    valid_args = (
-        f"{arg}={val}"
-        for arg, val in func_args.items()
-        if sig_params[arg].annotation not in ignore_arg_types
-    )
-    return ",".join(valid_args)
@@ -2,26 +2,56 @@
 from typing import Tuple, Callable, Optional
 
 import redis
+import redis.asyncio as aioredis
 
 from .enums import RedisStatus
 
+DEFAULT_MAX_CONNECTIONS = 50
+
 
 def redis_connect(
-    host_url: str, local: bool, password: str, port: int
-) -> Tuple[RedisStatus, redis.client.Redis]:
-    """Attempt to connect to `host_url`. If `local` is set to `True`, it will connect to `cloud` with `password` and return aRedis client instance if successful."""
-    connection_method = redis.from_url if local else redis.Redis
-    return _connect_generic(connection_method, host_url, password=password, port=port)
+    host_url: str,
+    local: bool,
+    password: str,
+    port: int,
+    max_connections: int = DEFAULT_MAX_CONNECTIONS,
+) -> Tuple[RedisStatus, Optional[aioredis.Redis]]:
+    """Attempt to connect to `host_url`. If `local` is set to `True`, it will connect to `cloud` with `password` and return an asyncio Redis client instance backed by a connection pool if successful."""
+    if local:
+        connection_method = redis.from_url
+        pool_method = aioredis.BlockingConnectionPool.from_url
+    else:
+        connection_method = redis.Redis
+        pool_method = _pool_for_host
+    return _connect_generic(
+        connection_method,
+        pool_method,
+        host_url,
+        max_connections,
+        password=password,
+        port=port,
+    )
+
+
+def _pool_for_host(host_url: str, **kwargs) -> aioredis.BlockingConnectionPool:
+    return aioredis.BlockingConnectionPool(host=host_url, **kwargs)
 
 
 def _connect_generic(
-    connection_method: Callable, *args, **kwargs
-) -> Tuple[RedisStatus, Optional[redis.client.Redis]]:
+    connection_method: Callable,
+    pool_method: Callable,
+    host_url: str,
+    max_connections: int,
+    **kwargs,
+) -> Tuple[RedisStatus, Optional[aioredis.Redis]]:
+    # `Cyrus` is created from a sync startup handler, so the server is probed with a short-lived sync client
     try:
-        redis_client = connection_method(*args, **kwargs)
+        with connection_method(host_url, **kwargs) as probe_client:
+            responded = probe_client.ping()
     except (redis.AuthenticationError, redis.ConnectionError):
         return RedisStatus.CONN_ERROR, None
 
-    if redis_client.ping():
-        return RedisStatus.CONNECTED, redis_client
-    return RedisStatus.CONN_ERROR, None
+    if not responded:
+        return RedisStatus.CONN_ERROR, None
+    pool = pool_method(host_url, max_connections=max_connections, **kwargs)
+    return RedisStatus.CONNECTED, aioredis.Redis.from_pool(pool)
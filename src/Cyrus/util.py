@@ -1,83 +1,170 @@
-import json
 from datetime import date, datetime
 from decimal import Decimal
 from enum import Enum
+from functools import singledispatch
+from typing import Callable, Dict
 from uuid import UUID
 
-from dateutil import parser
+import msgpack
+import orjson
+from msgpack import ExtType
 from pydantic import BaseModel
 from sqlalchemy.orm import InstanceState
 
-DATETIME_AWARE = "%m/%d/%Y %I:%M:%S %p %z"
-DATE_ONLY = "%m/%d/%Y"
+ORJSON_OPTIONS = orjson.OPT_NAIVE_UTC | orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
 
-ONE_HOUR_IN_SECONDS = 3600
+# MessagePack extension type codes for cached values
+EXT_DATETIME = 1
+EXT_DATE = 2
+EXT_DECIMAL = 3
+EXT_UUID = 4
+
+ONE_MINUTE_IN_SECONDS = 60
+ONE_HOUR_IN_SECONDS = ONE_MINUTE_IN_SECONDS * 60
 ONE_DAY_IN_SECONDS = ONE_HOUR_IN_SECONDS * 24
 ONE_WEEK_IN_SECONDS = ONE_DAY_IN_SECONDS * 7
 ONE_MONTH_IN_SECONDS = ONE_DAY_IN_SECONDS * 30
 ONE_YEAR_IN_SECONDS = ONE_DAY_IN_SECONDS * 365
 
-SERIALIZE_OBJ_MAP = {
-    str(datetime): parser.parse,
-    str(date): parser.parse,
-    str(Decimal): Decimal,
+
+def _identity(obj):
+    return obj
+
+
+def _encode_dict(obj):
+    return {
+        key: value
+        for key , value in obj.items()
+        if type(value) is not InstanceState
+    }
+
+
+def _encode_list(obj):
+    # If it's a list, apply serialization to each element
+    return [CustomJsonEncoder(element) for element in obj]
+
+
+def _encode_model(obj):
+    return obj.dict()
+
+
+def _encode_enum(obj):
+    return str(obj.value)
+
+
+@singledispatch
+def _encode_slow_path(obj):
+    """Fallback for subclasses of the types in `_ENCODERS`."""
+    return obj
+
+
+_encode_slow_path.register(dict, _encode_dict)
+_encode_slow_path.register(list, _encode_list)
+_encode_slow_path.register(BaseModel, _encode_model)
+_encode_slow_path.register(Enum, _encode_enum)
+
+_ENCODERS: Dict[type, Callable] = {
+    dict: _encode_dict,
+    list: _encode_list,
+    str: _identity,
+    int: _identity,
+    float: _identity,
+    bool: _identity,
+    type(None): _identity,
 }
 
 
-#! Improve Required
 def CustomJsonEncoder( obj ):
-    result = {}
-    if isinstance(obj , dict):
-        for key , value in obj.items():
-            if not isinstance(value , InstanceState):
-                if isinstance(value , datetime):
-                    result[key] = value.strftime(DATETIME_AWARE)
-                elif isinstance(value , Enum):
-                    result[key] = value.value
-                else:
-                    result[key] = value
-        return result
-    elif isinstance(obj , list):
-    # If it's a list, apply serialization to each element
-        return [CustomJsonEncoder(element) for element in obj]
-    elif isinstance(obj, datetime):
-        return {"val": obj.strftime(DATETIME_AWARE), "_spec_type": str(datetime)}
-    elif isinstance(obj, date):
-        return {"val": obj.strftime(DATE_ONLY), "_spec_type": str(date)}
-    elif isinstance(obj, Decimal):
-        return {"val": str(obj), "_spec_type": str(Decimal)}
-    elif isinstance(obj, BaseModel):
-        return obj.dict()
-    elif isinstance(obj, UUID):
-        return str(obj)
-    elif isinstance(obj, Enum):
-        return str(obj.value)
-    else:
-        return obj
+    fn = _ENCODERS.get(type(obj))
+    return fn(obj) if fn else _encode_slow_path(obj)
 
 
-def object_hook(obj):
-    if "_spec_type" not in obj:
-        return obj
-    _spec_type = obj["_spec_type"]
-    if _spec_type not in SERIALIZE_OBJ_MAP:  # pragma: no cover
-        raise TypeError(f'"{obj["val"]}" (type: {_spec_type}) is not JSON serializable')
-    return SERIALIZE_OBJ_MAP[_spec_type](obj["val"])
+def _default(obj):
+    """Serialize the types that `orjson` does not support natively."""
+    if isinstance(obj, Decimal):
+        # Same as FastAPI's `jsonable_encoder`, whole numbers become ints and the rest floats
+        return int(obj) if obj.as_tuple().exponent >= 0 else float(obj)
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f"Type is not JSON serializable: {type(obj).__name__}")
 
 
-def serialize_json(json_dict):
+def encode_payload(json_dict):
+    """Turn a dict, or a list of objects, into the plain data that gets cached."""
     if isinstance(json_dict, dict):
-        data = CustomJsonEncoder(obj = json_dict)
-        return json.dumps(data)
+        return CustomJsonEncoder(obj = json_dict)
+    return [CustomJsonEncoder(obj = obj.__dict__) for obj in json_dict]
+
+
+def dumps_json(data) -> bytes:
+    return orjson.dumps(data, default=_default, option=ORJSON_OPTIONS)
+
+
+def _pack_datetime(obj):
+    return ExtType(EXT_DATETIME, obj.isoformat().encode())
+
+
+def _pack_date(obj):
+    return ExtType(EXT_DATE, obj.isoformat().encode())
+
+
+def _pack_decimal(obj):
+    return ExtType(EXT_DECIMAL, str(obj).encode())
+
+
+def _pack_uuid(obj):
+    return ExtType(EXT_UUID, obj.bytes)
+
+
+_PACKERS: Dict[type, Callable] = {
+    datetime: _pack_datetime,
+    date: _pack_date,
+    Decimal: _pack_decimal,
+    UUID: _pack_uuid,
+}
+
+_UNPACKERS: Dict[int, Callable] = {
+    EXT_DATETIME: lambda data: datetime.fromisoformat(data.decode()),
+    EXT_DATE: lambda data: date.fromisoformat(data.decode()),
+    EXT_DECIMAL: lambda data: Decimal(data.decode()),
+    EXT_UUID: lambda data: UUID(bytes=data),
+}
+
+
+def _msgpack_default(obj):
+    """Serialize the types that `msgpack` does not support natively."""
+    fn = _PACKERS.get(type(obj))
+    if fn:
+        return fn(obj)
+    for obj_type, fn in _PACKERS.items():
+        if isinstance(obj, obj_type):
+            return fn(obj)
+    if isinstance(obj, Enum):
+        return obj.value
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f"Type is not MessagePack serializable: {type(obj).__name__}")
+
+
+def _ext_hook(code, data):
+    if code not in _UNPACKERS:  # pragma: no cover
+        return ExtType(code, data)
+    return _UNPACKERS[code](data)
+
+
+def pack(obj) -> bytes:
+    return msgpack.packb(obj, default=_msgpack_default, use_bin_type=True)
+
+
+def unpack(packed: bytes):
+    return msgpack.unpackb(packed, ext_hook=_ext_hook, raw=False, strict_map_key=False)
 
-    else:
-        data_main= []
-        for obj in json_dict:
-            data = CustomJsonEncoder(obj = obj.__dict__)
-            data_main.append(data)
 
-        return json.dumps(data_main)
+def pack_cached(key: str, payload) -> bytes:
+    """Build the value stored in Redis for `key`."""
+    return pack({key: payload})
 
 
-def deserialize_json(json_str):
-    return json.loads(json_str, object_hook=object_hook)
+def unpack_cached(key: str, cached: bytes):
+    """Return the payload stored under `key` by `pack_cached`."""
+    return unpack(cached)[key]